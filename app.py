@@ -1,15 +1,16 @@
 # app.py
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import streamlit as st
 import plotly.express as px
 from temperature_analyzer import TemperatureAnalyzer
 import folium
 from streamlit_folium import st_folium
 
-# Initialize session state for caching
-if 'analyzer' not in st.session_state:
-    st.session_state.analyzer = None
-if 'last_params' not in st.session_state:
-    st.session_state.last_params = None
+# Bound the Streamlit caches so a long-running server doesn't grow without limit
+CACHE_TTL = 24 * 60 * 60  # One day
 
 st.set_page_config(page_title="Temperature Analysis", layout="wide")
 st.title("Global Temperature Analysis")
@@ -24,16 +25,23 @@ scenario = st.sidebar.selectbox(
     index=3
 )
 
-# Check if we need to reinitialize the analyzer
-current_params = (start_year, end_year, scenario)
-if st.session_state.last_params != current_params:
-    st.session_state.analyzer = TemperatureAnalyzer(start_year, end_year, scenario)
-    st.session_state.last_params = current_params
+# Share one analyzer per parameter set across reruns and sessions
+@st.cache_resource(max_entries=4)
+def get_analyzer(start_year, end_year, scenario):
+    return TemperatureAnalyzer(start_year, end_year, scenario)
 
-# Cache the map
-@st.cache_data
+analyzer = get_analyzer(start_year, end_year, scenario)
+
+# Build the map once per process; CartoDB tiles are served with long cache headers
+@st.cache_resource
 def get_base_map():
-    return folium.Map(location=[0, 0], zoom_start=2)
+    return folium.Map(location=[0, 0], zoom_start=2, tiles='CartoDB positron',
+                      prefer_canvas=True)
+
+# Earth Engine fetches run here so the script thread can keep updating the UI
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=4)
 
 st.write("Click on the map to select a location:")
 map_data = st_folium(get_base_map(), height=400)
@@ -42,65 +50,71 @@ if map_data['last_clicked']:
     lat = map_data['last_clicked']['lat']
     lon = map_data['last_clicked']['lng']
     
-    # Get temperature data with progress
-    with st.spinner("Fetching temperature data..."):
-        # Cache key for this location and parameters
-        cache_key = st.session_state.analyzer._generate_cache_key(
-            lat, lon, 
-            start_year=start_year,
-            end_year=end_year,
-            scenario=scenario
-        )
-        
-        # Check cache first
-        @st.cache_data(ttl=3600)  # Cache for 1 hour
-        def get_cached_data(cache_key):
-            return st.session_state.analyzer.get_point_data(lat, lon)
-        
-        data = get_cached_data(cache_key)
-        
-        # Format data for plotting
-        @st.cache_data
-        def get_formatted_data(data_str):
-            return st.session_state.analyzer.format_data_for_plotting(data_str)
-        
-        df = get_formatted_data(str(data))
+    # Snap to the data grid; every click inside a cell is the same query
+    lat, lon = analyzer._snap_to_grid(lat), analyzer._snap_longitude(lon)
+    point_key = (lat, lon, start_year, end_year, scenario)
+    
+    # Cache key for this location and parameters
+    cache_key = analyzer._generate_cache_key(
+        lat, lon, 
+        start_year=start_year,
+        end_year=end_year,
+        scenario=scenario
+    )
+    
+    # Check cache first
+    @st.cache_data(ttl=3600, max_entries=64)  # Cache for 1 hour
+    def get_cached_data(cache_key):
+        return analyzer.get_point_data(lat, lon)
+    
+    # Format data for plotting, keyed on the small cache key
+    # rather than hashing the data itself (_data is not hashed)
+    @st.cache_data(ttl=CACHE_TTL, max_entries=64, show_spinner=False)
+    def get_formatted_data(cache_key, _data=None):
+        if _data is None:
+            _data = get_cached_data(cache_key)
+        return analyzer.format_data_for_plotting(_data)
 
     # Plot with caching
-    @st.cache_data
-    def create_plot(df, lat, lon):
+    @st.cache_data(ttl=CACHE_TTL, max_entries=16, show_spinner=False)
+    def create_plot(cache_key, lat, lon):
+        bundle = get_formatted_data(cache_key)
+
         # Create figure with secondary y-axis
-        fig = px.line(df, x='date', y=['GLDAS'], 
+        fig = px.line(x=bundle.dates, y=bundle.gldas,
                      title=f"Temperature at {lat:.2f}°N, {lon:.2f}°E",
-                     labels={'value': 'Temperature (°C)',
-                            'variable': 'Dataset'})
+                     labels={'x': 'Date', 'y': 'Temperature (°C)'})
         
         # Update GLDAS line style
-        fig.update_traces(line=dict(color='blue', width=3), name='GLDAS (Historical)')
-        
-        # Add CMIP6 model lines
-        cmip6_cols = [col for col in df.columns if col.startswith('CMIP6_') 
-                     and not col.startswith('CMIP6_std')
-                     and not col.endswith(('mean', 'upper', 'lower'))]
+        fig.update_traces(line=dict(color='blue', width=3), name='GLDAS (Historical)',
+                          showlegend=True)
         
-        for col in cmip6_cols:
-            fig.add_scatter(x=df['date'], y=df[col],
-                          name=col.replace('CMIP6_', ''),
-                          line=dict(color='red', width=0.5, opacity=0.3),
+        # Draw every model as one trace, with a NaN gap between models
+        n_models = len(bundle.models)
+        if n_models:
+            gap = np.full((1, n_models), np.nan, dtype=np.float32)
+            y = np.vstack([bundle.cmip6, gap]).ravel(order='F')
+            x = np.tile(np.append(bundle.dates, bundle.dates[-1:]), n_models)
+            fig.add_scatter(x=x, y=y,
+                          name='CMIP6 Models',
+                          mode='lines',
+                          connectgaps=False,
+                          line=dict(color='rgba(255,0,0,0.3)', width=0.5),
+                          hoverinfo='skip',
                           showlegend=True)
         
         # Add ensemble mean and confidence interval
-        fig.add_scatter(x=df['date'], y=df['CMIP6_mean'],
+        fig.add_scatter(x=bundle.dates, y=bundle.cmip6_mean,
                        name='CMIP6 Ensemble Mean',
                        line=dict(color='red', width=2),
                        showlegend=True)
         
-        fig.add_scatter(x=df['date'], y=df['CMIP6_upper'],
+        fig.add_scatter(x=bundle.dates, y=bundle.cmip6_upper,
                        name='95% Confidence Interval',
                        line=dict(color='red', width=0),
                        showlegend=False)
         
-        fig.add_scatter(x=df['date'], y=df['CMIP6_lower'],
+        fig.add_scatter(x=bundle.dates, y=bundle.cmip6_lower,
                        name='95% Confidence Interval',
                        fill='tonexty',
                        fillcolor='rgba(255,0,0,0.2)',
@@ -112,6 +126,7 @@ if map_data['last_clicked']:
             yaxis_title='Temperature (°C)',
             xaxis_title='Date',
             hovermode='x unified',
+            uirevision=cache_key,
             legend=dict(
                 yanchor="top",
                 y=0.99,
@@ -121,22 +136,51 @@ if map_data['last_clicked']:
         )
         
         return fig
+
+    # Only fetch and plot when the point or parameters changed since the last run
+    if st.session_state.get('last_key') != point_key or 'last_fig' not in st.session_state:
+        # Get temperature data in the background, reporting progress meanwhile
+        with st.status("Fetching temperature data...") as status:
+            # Reuse a fetch still in flight for this point; cancel one for a stale point
+            pending = st.session_state.get('pending_fetch')
+            if pending and pending[0] == point_key:
+                _, future, started = pending
+            else:
+                if pending:
+                    pending[1].cancel()
+                started = time.time()
+                future = get_executor().submit(analyzer.get_point_data, lat, lon)
+                st.session_state.pending_fetch = (point_key, future, started)
+            
+            while not future.done():
+                status.update(label=f"Fetching temperature data... ({int(time.time() - started)}s)")
+                time.sleep(0.5)
+            try:
+                data = future.result()
+            finally:
+                st.session_state.pop('pending_fetch', None)
+            
+            get_formatted_data(cache_key, data)
+            status.update(label="Temperature data loaded", state="complete")
+        
+        st.session_state.last_fig = create_plot(cache_key, lat, lon)
+        st.session_state.last_key = point_key
+    
+    st.plotly_chart(st.session_state.last_fig, use_container_width=True)
     
     # Display statistics with caching
-    @st.cache_data
-    def calculate_stats(df):
-        cmip6_cols = [col for col in df.columns if col.startswith('CMIP6_') 
-                     and not col.startswith('CMIP6_std')
-                     and not col.endswith(('mean', 'upper', 'lower'))]
+    @st.cache_data(ttl=CACHE_TTL, max_entries=64, show_spinner=False)
+    def calculate_stats(cache_key):
+        bundle = get_formatted_data(cache_key)
         
         return {
-            'gldas_mean': df['GLDAS'].mean(),
-            'cmip6_ensemble_mean': df['CMIP6_mean'].mean(),
-            'model_count': len(cmip6_cols),
-            'ensemble_spread': df['CMIP6_std'].mean()
+            'gldas_mean': np.nanmean(bundle.gldas),
+            'cmip6_ensemble_mean': np.nanmean(bundle.cmip6_mean),
+            'model_count': len(bundle.models),
+            'ensemble_spread': np.nanmean(bundle.cmip6_std)
         }
     
-    stats = calculate_stats(df)
+    stats = calculate_stats(cache_key)
     col1, col2, col3, col4 = st.columns(4)
     with col1:
         st.metric("GLDAS Mean", f"{stats['gldas_mean']:.1f}°C")
@@ -148,11 +192,14 @@ if map_data['last_clicked']:
         st.metric("Ensemble Spread", f"±{stats['ensemble_spread']:.1f}°C")
 
     # Add download button for the data
-    @st.cache_data
-    def convert_df_to_csv(df):
-        return df.to_csv().encode('utf-8')
+    @st.cache_data(ttl=CACHE_TTL, max_entries=64, show_spinner=False)
+    def convert_df_to_csv(cache_key):
+        df = get_formatted_data(cache_key).to_dataframe()
+        buf = io.BytesIO()
+        df.to_csv(buf, index=False, encoding='utf-8')
+        return buf.getvalue()
 
-    csv = convert_df_to_csv(df)
+    csv = convert_df_to_csv(cache_key)
     st.download_button(
         "Download Data as CSV",
         csv,
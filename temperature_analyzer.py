@@ -1,22 +1,85 @@
 # temperature_analyzer.py
 import ee
+import numpy as np
 import pandas as pd
 import datetime
+from dataclasses import dataclass
 from typing import Dict, List, Tuple
-from functools import lru_cache
 import hashlib
 import json
+import math
+import warnings
+import diskcache
+from concurrent.futures import ThreadPoolExecutor
+
+# High-volume endpoint for interactive, many-request workloads
+EE_HIGH_VOLUME_URL = 'https://earthengine-highvolume.googleapis.com'
+
+_ee_initialized = False
+
+# Persistent cache of Earth Engine responses, shared across processes and users
+_cache = diskcache.Cache("./ee_cache")
+CACHE_EXPIRY = 7 * 24 * 3600  # One week
+
+# Native grid spacing of GLDAS and NEX-GDDP-CMIP6, in degrees
+GRID_RESOLUTION = 0.25
+
+# Concurrent requests when falling back to one request per model
+MAX_WORKERS = 16
+
+KELVIN_OFFSET = 273.15
+
+# Bump when the shape, units or coverage of cached responses change
+CACHE_VERSION = 3
+
+def _initialize_ee():
+    """Initialize Earth Engine once per process against the high-volume endpoint."""
+    global _ee_initialized
+    if not _ee_initialized:
+        ee.Initialize(opt_url=EE_HIGH_VOLUME_URL)
+        _ee_initialized = True
+
+@dataclass
+class EnsembleBundle:
+    """Columnar point data: a date axis, the GLDAS series and a (time, model) CMIP6 matrix."""
+    dates: np.ndarray
+    gldas: np.ndarray
+    cmip6: np.ndarray
+    models: List[str]
+    cmip6_mean: np.ndarray
+    cmip6_std: np.ndarray
+
+    @property
+    def cmip6_upper(self) -> np.ndarray:
+        return self.cmip6_mean + 2 * self.cmip6_std
+
+    @property
+    def cmip6_lower(self) -> np.ndarray:
+        return self.cmip6_mean - 2 * self.cmip6_std
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Build the wide DataFrame, one column per series, for export."""
+        return pd.DataFrame({
+            'date': self.dates,
+            'GLDAS': self.gldas,
+            **{f'CMIP6_{model}': self.cmip6[:, i] for i, model in enumerate(self.models)},
+            'CMIP6_mean': self.cmip6_mean,
+            'CMIP6_std': self.cmip6_std,
+            'CMIP6_upper': self.cmip6_upper,
+            'CMIP6_lower': self.cmip6_lower
+        })
 
 class TemperatureAnalyzer:
     def __init__(self, start_year: int = 2010, end_year: int = 2050, scenario: str = 'ssp585'):
         """Initialize the analyzer with time range and scenario."""
-        ee.Initialize()
+        _initialize_ee()
         
         self.start_year = start_year
         self.end_year = end_year
         self.scenario = scenario
         self.historical_cutoff = 2022
         self.cmip6_transition = 2015
+        self._dates = pd.date_range(f"{start_year}-01-01", f"{end_year}-12-31", freq='ME')
         
         # Initialize and cache datasets
         self._init_datasets()
@@ -26,10 +89,11 @@ class TemperatureAnalyzer:
         self.gldas = ee.ImageCollection("NASA/GLDAS/V021/NOAH/G025/T3H")
         self.cmip6 = ee.ImageCollection("NASA/GDDP-CMIP6")
         
-        # Pre-filter datasets by date range
+        # Pre-filter datasets by date range; end dates are exclusive, so stop at
+        # Jan 1 of the following year to keep every year complete for the year cache
         self.start_date = ee.Date.fromYMD(self.start_year, 1, 1)
-        self.end_date = ee.Date.fromYMD(self.end_year, 12, 31)
-        self.historical_end = ee.Date.fromYMD(min(self.historical_cutoff, self.end_year), 12, 31)
+        self.end_date = ee.Date.fromYMD(self.end_year + 1, 1, 1)
+        self.historical_end = ee.Date.fromYMD(min(self.historical_cutoff, self.end_year) + 1, 1, 1)
         
         # Cache the filtered collections
         self.filtered_gldas = self.gldas.select('Tair_f_inst').filterDate(self.start_date, self.historical_end)
@@ -38,80 +102,149 @@ class TemperatureAnalyzer:
             .filter(ee.Filter.eq('scenario', self.scenario))
             .filterDate(self.start_date, self.end_date))
 
+        # The model list depends only on scenario and date range, not the point
+        self._models = self.filtered_cmip6.distinct('model').aggregate_array('model').getInfo()
+
+    @staticmethod
+    def _snap_to_grid(value: float) -> float:
+        """Snap a coordinate to the centre of its 0.25° grid cell."""
+        return math.floor(value / GRID_RESOLUTION) * GRID_RESOLUTION + GRID_RESOLUTION / 2
+
+    @staticmethod
+    def _snap_longitude(lon: float) -> float:
+        """Wrap a longitude into [-180, 180) and snap it to its grid cell centre."""
+        # Leaflet reports clicks on repeated world copies with longitudes beyond ±180
+        return TemperatureAnalyzer._snap_to_grid((lon + 180) % 360 - 180)
+
     @staticmethod
     def _generate_cache_key(lat: float, lon: float, **kwargs) -> str:
         """Generate a unique cache key based on parameters."""
         params = {
-            'lat': round(lat, 4),
-            'lon': round(lon, 4),
+            'lat': TemperatureAnalyzer._snap_to_grid(lat),
+            'lon': TemperatureAnalyzer._snap_longitude(lon),
             **kwargs
         }
         key = json.dumps(params, sort_keys=True)
         return hashlib.md5(key.encode()).hexdigest()
 
-    @lru_cache(maxsize=128)
-    def get_point_data_cached(self, cache_key: str) -> Dict:
-        """Cached version of point data retrieval."""
-        # Parse lat/lon from cache_key
-        params = json.loads(cache_key)
-        point = ee.Geometry.Point(params['lon'], params['lat'])
+    def get_point_data(self, lat: float, lon: float) -> Dict:
+        """Get data for all CMIP6 models at a point, fetching only uncached years."""
+        # Query the cell centre so every click in the same cell computes the same thing
+        lat, lon = self._snap_to_grid(lat), self._snap_longitude(lon)
+        years = range(self.start_year, self.end_year + 1)
 
-        gldas_data = self.filtered_gldas.filterBounds(point)
-        cmip6_data = self.filtered_cmip6.filterBounds(point)
+        # Cached per year, so widening the range only fetches the new years
+        cache_keys = {year: self._generate_cache_key(lat, lon,
+                                                     scenario=self.scenario,
+                                                     year=year,
+                                                     version=CACHE_VERSION)
+                      for year in years}
+        by_year = {year: _cache.get(key) for year, key in cache_keys.items()}
+        missing = [year for year, data in by_year.items() if data is None]
 
-        # Calculate monthly averages
-        gldas_monthly = self._calculate_monthly_average(gldas_data, point, 'Tair_f_inst')
-        cmip6_monthly = self._calculate_monthly_average(cmip6_data, point, 'tas')
+        if missing:
+            fetched = self._fetch_years(lat, lon, missing)
+            for year in missing:
+                by_year[year] = fetched[year]
+                _cache.set(cache_keys[year], fetched[year], expire=CACHE_EXPIRY)
 
+        # Concatenate the yearly pieces in date order
         return {
-            'gldas': gldas_monthly.getInfo(),
-            'cmip6': cmip6_monthly.getInfo(),
+            'gldas': [pair for year in years for pair in by_year[year]['gldas']],
+            'cmip6_models': {
+                model: [pair for year in years
+                        for pair in by_year[year]['cmip6_models'].get(model, [])]
+                for model in self._models
+            },
             'metadata': {
-                'lat': params['lat'],
-                'lon': params['lon'],
-                'scenario': self.scenario
+                'lat': lat,
+                'lon': lon,
+                'scenario': self.scenario,
+                'models': self._models
             }
         }
 
-    def get_point_data(self, lat: float, lon: float) -> Dict:
-        """Get data for all CMIP6 models at a point."""
-        cache_key = self._generate_cache_key(lat, lon, 
-                                           start_year=self.start_year,
-                                           end_year=self.end_year,
-                                           scenario=self.scenario)
-        
+    def _fetch_years(self, lat: float, lon: float, years: List[int]) -> Dict[int, Dict]:
+        """Fetch GLDAS and all CMIP6 models for the given years in a single request."""
         point = ee.Geometry.Point(lon, lat)
+        year_filter = self._year_filter(years)
         
         # Get GLDAS data as before
-        gldas_data = self.filtered_gldas.filterBounds(point)
+        gldas_data = self.filtered_gldas.filter(year_filter).filterBounds(point)
         gldas_monthly = self._calculate_monthly_average(gldas_data, point, 'Tair_f_inst')
 
-        # Get all unique CMIP6 models
-        models = self.filtered_cmip6.distinct('model').aggregate_array('model').getInfo()
-        
-        # Get data for each model
-        cmip6_by_model = {}
-        for model in models:
-            model_data = (self.filtered_cmip6
-                .filter(ee.Filter.eq('model', model))
-                .filterBounds(point))
-            cmip6_by_model[model] = self._calculate_monthly_average(model_data, point, 'tas')
+        # Build the per-model series server-side as a dictionary keyed by model
+        cmip6_data = self.filtered_cmip6.filter(year_filter).filterBounds(point)
+        models = ee.List(self._models)
+        cmip6_by_model = ee.Dictionary.fromLists(
+            models,
+            models.map(lambda model: self._calculate_monthly_average(
+                cmip6_data.filter(ee.Filter.eq('model', model)), point, 'tas'))
+        )
+
+        # Fold everything into one dictionary so the whole click is one getInfo()
+        try:
+            result = ee.Dictionary({
+                'gldas': gldas_monthly,
+                'cmip6_models': cmip6_by_model
+            }).getInfo()
+        except ee.EEException:
+            # The combined request can exceed per-request limits; split it per model
+            result = self._fetch_per_model(cmip6_data, point, gldas_monthly)
 
+        # Split the response back into one entry per year
+        gldas_by_year = self._split_by_year(result['gldas'], years)
+        cmip6_by_year = {model: self._split_by_year(pairs, years)
+                         for model, pairs in result['cmip6_models'].items()}
         return {
-            'gldas': gldas_monthly.getInfo(),
-            'cmip6_models': {model: data.getInfo() for model, data in cmip6_by_model.items()},
-            'metadata': {
-                'lat': lat,
-                'lon': lon,
-                'scenario': self.scenario,
-                'models': models
+            year: {
+                'gldas': gldas_by_year[year],
+                'cmip6_models': {model: split[year] for model, split in cmip6_by_year.items()}
             }
+            for year in years
+        }
+
+    @staticmethod
+    def _year_filter(years: List[int]) -> ee.Filter:
+        """Filter matching the given years, one calendarRange per contiguous run."""
+        runs = []
+        for year in sorted(years):
+            if runs and year == runs[-1][1] + 1:
+                runs[-1][1] = year
+            else:
+                runs.append([year, year])
+
+        filters = [ee.Filter.calendarRange(start, end, 'year') for start, end in runs]
+        return filters[0] if len(filters) == 1 else ee.Filter.Or(*filters)
+
+    @staticmethod
+    def _split_by_year(pairs: List, years: List[int]) -> Dict[int, List]:
+        """Group [date, temperature] pairs by the year of their YYYY-MM date."""
+        by_year = {year: [] for year in years}
+        for pair in pairs:
+            year = int(pair[0][:4])
+            if year in by_year:
+                by_year[year].append(pair)
+        return by_year
+
+    def _fetch_per_model(self, cmip6_data, point, gldas_monthly) -> Dict:
+        """Fetch GLDAS and each CMIP6 model as separate, concurrent requests."""
+        def fetch(model):
+            model_data = cmip6_data.filter(ee.Filter.eq('model', model))
+            return model, self._calculate_monthly_average(model_data, point, 'tas').getInfo()
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            gldas_future = executor.submit(gldas_monthly.getInfo)
+            cmip6_by_model = dict(executor.map(fetch, self._models))
+
+        return {
+            'gldas': gldas_future.result(),
+            'cmip6_models': cmip6_by_model
         }
 
     @staticmethod
-    @lru_cache(maxsize=128)
     def _calculate_monthly_average(collection, point, band_name: str) -> ee.List:
-        """Cached version of monthly average calculation."""
+        """Monthly average calculation, as [date, temperature (K)] pairs."""
         def monthly_reducer(image):
             value = image.reduceRegion(
                 reducer=ee.Reducer.mean(),
@@ -119,40 +252,55 @@ class TemperatureAnalyzer:
                 scale=25000
             ).get(band_name)
             
-            temp_c = ee.Number(value).subtract(273.15)
-            
+            # Left in Kelvin; converted client-side in format_data_for_plotting
             return ee.Feature(None, {
-                'temperature': temp_c,
+                'temperature': value,
                 'date': image.date().format('YYYY-MM')
             })
 
-        return collection.map(monthly_reducer).aggregate_array('temperature')
+        return ee.List(collection.map(monthly_reducer)
+            .reduceColumns(ee.Reducer.toList(2), ['date', 'temperature'])
+            .get('list'))
 
-    @lru_cache(maxsize=128)
-    def format_data_for_plotting(self, data_key: str) -> pd.DataFrame:
+    @staticmethod
+    def _to_monthly_series(pairs: List) -> pd.Series:
+        """Average [date, temperature] pairs into a series indexed by month end."""
+        if not pairs:
+            return pd.Series(dtype=float)
+        months, values = zip(*pairs)
+        index = pd.to_datetime(months, format='%Y-%m') + pd.offsets.MonthEnd(0)
+        return pd.Series(values, index=index, dtype=float).groupby(level=0).mean()
+
+    def format_data_for_plotting(self, raw_data: Dict) -> EnsembleBundle:
         """Format data including all CMIP6 models."""
-        raw_data = json.loads(data_key)
-        dates = pd.date_range(
-            start=f"{self.start_year}-01-01",
-            end=f"{self.end_year}-12-31",
-            freq='M'
-        )
+        dates = self._dates
 
-        # Start with GLDAS data
-        df = pd.DataFrame({
-            'date': dates,
-            'GLDAS': raw_data['gldas'][:len(dates)]
-        })
+        # Start with GLDAS data, aligned on date rather than position
+        gldas = self._to_monthly_series(raw_data['gldas']).reindex(dates).to_numpy(np.float32)
+
+        # Fill one (time, model) matrix with every CMIP6 model
+        models = list(raw_data['cmip6_models'])
+        cmip6 = np.empty((len(dates), len(models)), dtype=np.float32)
+        for i, model in enumerate(models):
+            series = self._to_monthly_series(raw_data['cmip6_models'][model])
+            cmip6[:, i] = series.reindex(dates).to_numpy()
 
-        # Add each CMIP6 model
-        for model, data in raw_data['cmip6_models'].items():
-            df[f'CMIP6_{model}'] = data[:len(dates)]
+        # Convert Kelvin to Celsius once, on the downloaded arrays
+        gldas -= KELVIN_OFFSET
+        cmip6 -= KELVIN_OFFSET
 
-        # Calculate ensemble statistics
-        cmip6_cols = [col for col in df.columns if col.startswith('CMIP6_')]
-        df['CMIP6_mean'] = df[cmip6_cols].mean(axis=1)
-        df['CMIP6_std'] = df[cmip6_cols].std(axis=1)
-        df['CMIP6_upper'] = df['CMIP6_mean'] + 2 * df['CMIP6_std']
-        df['CMIP6_lower'] = df['CMIP6_mean'] - 2 * df['CMIP6_std']
+        # Calculate ensemble statistics in one pass over the model matrix
+        with warnings.catch_warnings():
+            # Months before the scenario starts have no models; NaN is expected there
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(cmip6, axis=1)
+            std = np.nanstd(cmip6, axis=1, ddof=1)
 
-        return df
\ No newline at end of file
+        return EnsembleBundle(
+            dates=dates.to_numpy(),
+            gldas=gldas,
+            cmip6=cmip6,
+            models=models,
+            cmip6_mean=mean,
+            cmip6_std=std
+        )